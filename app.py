@@ -2,13 +2,19 @@ import streamlit as st
 import gspread
 from google.oauth2.service_account import Credentials
 import pandas as pd
+import numpy as np
 import datetime
 import io
 import os
 import re
+import tempfile
 import base64
-import random
-import time
+import functools
+import itertools
+import queue
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from pdf2image import convert_from_bytes
 from docx import Document
@@ -16,9 +22,20 @@ from docx.shared import Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition, Email
+from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition, Email, Personalization, To, Cc
 from python_http_client.exceptions import HTTPError
 
+# ============================================================
+# --- Precompiled Patterns ---
+# ============================================================
+
+_RE_DOUBLE = re.compile(r'【】(.*?)【】')           # 專名號
+_RE_SINGLE = re.compile(r'【(.+?)】')               # 填充位
+_RE_BRACKETS = re.compile(r'【|】')
+_RE_EMAIL = re.compile(r'^[\w\.-]+@[\w\.-]+\.\w+$')
+_RE_SAFE_NAME = re.compile(r'[^\w\-]')
+_RE_EMAIL_SEP = re.compile(r'[,;\s]+')
+
 # ============================================================
 # --- Streamlit Setup ---
 # ============================================================
@@ -47,21 +64,33 @@ try:
     from reportlab.pdfbase import pdfmetrics
     from reportlab.pdfbase.ttfonts import TTFont
 
+    # 單一字型的 .ttf 優先；.ttc 字型集合放最後
     font_paths = [
         "Kai.ttf",
-        "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
-        "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf"
+        "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+        "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc"
     ]
 
-    CHINESE_FONT = None
-    for path in font_paths:
-        if os.path.exists(path):
-            try:
-                pdfmetrics.registerFont(TTFont("ChineseFont", path))
-                CHINESE_FONT = "ChineseFont"
-                break
-            except Exception:
-                continue
+    @st.cache_resource(show_spinner=False)
+    def _register_chinese_font():
+        """尋找並註冊中文字型；成功後每個程序只執行一次。找不到時拋出，不快取失敗結果，下次 rerun 會再嘗試"""
+        # 清除快取後 reportlab 仍保留已註冊的字型，毋須重新解析 TTF
+        if "ChineseFont" in pdfmetrics.getRegisteredFontNames():
+            return "ChineseFont"
+        for path in font_paths:
+            if os.path.exists(path):
+                try:
+                    # .ttc 明確取第一個字型；對單一 .ttf 無影響
+                    pdfmetrics.registerFont(TTFont("ChineseFont", path, subfontIndex=0))
+                    return "ChineseFont"
+                except Exception:
+                    continue
+        raise FileNotFoundError("no usable Chinese font")
+
+    try:
+        CHINESE_FONT = _register_chinese_font()
+    except FileNotFoundError:
+        CHINESE_FONT = None
 
     if not CHINESE_FONT:
         st.error("❌ Chinese font not found. Please ensure Kai.ttf is in your GitHub repository.")
@@ -74,16 +103,21 @@ except ImportError:
 # --- Google Sheet Connection ---
 # ============================================================
 
-try:
-    key_dict = st.secrets["gcp_service_account"]
+@st.cache_resource(show_spinner=False)
+def _gspread_client():
+    """gspread client：憑證解析與授權每個程序只做一次，不必每次 rerun 重建"""
     creds = Credentials.from_service_account_info(
-        key_dict,
+        st.secrets["gcp_service_account"],
         scopes=[
             "https://www.googleapis.com/auth/spreadsheets",
             "https://www.googleapis.com/auth/drive.file"
         ]
     )
-    client = gspread.authorize(creds)
+    return gspread.authorize(creds)
+
+
+try:
+    client = _gspread_client()
     SHEET_ID = st.secrets["app_config"]["spreadsheet_id"]
 
 except Exception as e:
@@ -94,43 +128,115 @@ except Exception as e:
 # --- Google Sheet Loader ---
 # ============================================================
 
-def load_sheet(sheet_name: str) -> pd.DataFrame:
+@st.cache_resource(show_spinner=False)
+def _spreadsheet():
+    """試算表 handle：每個程序只開啟一次，讀寫共用"""
+    return client.open_by_key(SHEET_ID)
+
+
+STANDBY_COLUMNS = ["ID", "School", "level", "Word", "Type", "Content", "Answer", "Status", "Entry_Date"]  # A:I
+SHEET_RANGES = ["'standby'!A:I", "'學生資料'"]
+STANDBY_STATUS_COL = 8  # Status 是第 8 欄
+STANDBY_STATUS_LETTER = gspread.utils.rowcol_to_a1(1, STANDBY_STATUS_COL).rstrip("0123456789")  # "H"
+
+
+def _frame_from_values(values) -> pd.DataFrame:
+    """將 values API 回傳的二維清單轉成 DataFrame（第一列為標題）"""
+    if not values:
+        return pd.DataFrame()
+    header = [str(c).strip() for c in values[0]]
+    width = len(header)
+    # values API 會省略每列尾端的空白儲存格，需補齊
+    rows = [row[:width] + [""] * (width - len(row)) for row in values[1:]]
+    # 先轉成 Arrow 字串欄位再去空白：strip（含全形空格 / NBSP）、比較、isin 皆走 Arrow compute kernel
+    df = pd.DataFrame(rows, columns=header).astype("string[pyarrow]")
+    df = df.apply(lambda col: col.str.strip())
+    # 去除全空白列；保留原本的 index，列號對應（index + 2）不變
+    return df[(df != "").any(axis=1)]
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def load_all_sheets():
+    """
+    以單一 values.batchGet 請求同時讀取 standby 及 學生資料；失敗時直接拋出，錯誤結果不會被快取
+    回傳 (fetch_id, frames)：fetch_id 每次實際讀取都不同，用來判斷本地「已使用」標記是否仍適用
+    """
+    sh = _spreadsheet()
+    resp = sh.values_batch_get(SHEET_RANGES)
+    value_ranges = resp.get("valueRanges", [])
+    frames = [_frame_from_values(vr.get("values", [])) for vr in value_ranges]
+    frames += [pd.DataFrame()] * (len(SHEET_RANGES) - len(frames))
+    return uuid.uuid4().hex, tuple(frames)
+
+
+def load_students():
+    """載入 學生資料；讀取失敗時顯示錯誤並回傳空表，下次 rerun 會重新讀取"""
     try:
-        sh = client.open_by_key(SHEET_ID)
-        ws = sh.worksheet(sheet_name)
-        df = pd.DataFrame(ws.get_all_records())
-        df.columns = [c.strip() for c in df.columns]
-        for col in df.columns:
-            df[col] = df[col].astype(str).str.strip()
-        return df
+        return load_all_sheets()[1][1]
     except Exception as e:
-        st.error(f"❌ 無法讀取工作表「{sheet_name}」: {e}")
+        st.error(f"❌ 無法讀取學生資料: {e}")
         return pd.DataFrame()
 
 
-@st.cache_data(ttl=60)
-def load_students():
-    return load_sheet("學生資料")
+@st.cache_resource
+def _used_rows_overlay():
+    """
+    本程序在目前這份快取資料讀取後才標記為「已使用」的 standby 列號
+    只對應 fetch_id 那一次讀取；重新讀取後的資料已包含這些寫入，列號即作廢
+    各 session 共用，讀寫都須持有 lock
+    """
+    return {"lock": threading.Lock(), "fetch_id": None, "rows": set()}
 
 
-@st.cache_data(ttl=60)
 def load_standby():
-    """載入 standby 工作表（題庫）"""
+    """載入 standby 工作表（題庫）；讀取失敗時顯示錯誤並回傳空表"""
+    overlay = _used_rows_overlay()
     try:
-        return load_sheet("standby")
-    except Exception:
-        return pd.DataFrame()
+        fetch_id, frames = load_all_sheets()
+        # 一次補齊缺少的欄位（空字串），後續毋須逐欄檢查；標題重複時 reindex 會拋出，一併顯示錯誤
+        df = frames[0].reindex(columns=frames[0].columns.union(STANDBY_COLUMNS, sort=False), fill_value="")
+        with overlay["lock"]:
+            if overlay["fetch_id"] != fetch_id:
+                overlay["fetch_id"] = fetch_id
+                overlay["rows"] = set()
+            used_rows = frozenset(overlay["rows"])
+    except Exception as e:
+        st.error(f"❌ 無法讀取 standby 工作表: {e}")
+        df, used_rows = pd.DataFrame(columns=STANDBY_COLUMNS), frozenset()
+    if used_rows:
+        df.loc[(df.index + 2).isin(used_rows), "Status"] = "已使用"
+    return df
+
+
+def _contiguous_runs(rows):
+    """將已排序的列號分組為連續區段 [(start, end), ...]"""
+    runs = []
+    for r in rows:
+        if runs and r == runs[-1][1] + 1:
+            runs[-1][1] = r
+        else:
+            runs.append([r, r])
+    return runs
 
 
-def update_status_to_used(row_indices):
-    """更新 standby 工作表中句子的狀態為已使用"""
+def update_status_to_used(sheet_rows):
+    """更新 standby 工作表中句子的狀態為已使用（單一 batch_update 請求）"""
     try:
-        sh = client.open_by_key(SHEET_ID)
-        ws = sh.worksheet("standby")
-        for idx in row_indices:
-            gs_row = idx + 2  # pandas 0-based → Google Sheets 1-based (header = row 1)
-            ws.update_cell(gs_row, 8, "已使用")  # Status 是第 8 欄
-        return True, f"成功更新 {len(row_indices)} 筆記錄"
+        sh = _spreadsheet()
+        gs_rows = sorted(set(sheet_rows))
+        # 直接以 'standby'!H2:H5 形式寫入，毋須先查詢 worksheet metadata
+        updates = [
+            {"range": f"'standby'!{STANDBY_STATUS_LETTER}{start}:{STANDBY_STATUS_LETTER}{end}",
+             "values": [["已使用"]] * (end - start + 1)}
+            for start, end in _contiguous_runs(gs_rows)
+        ]
+        if updates:
+            sh.values_batch_update({"valueInputOption": "RAW", "data": updates})
+            # 目前快取的資料讀取於這次寫入之前，記下列號直到下一次重新讀取
+            overlay = _used_rows_overlay()
+            with overlay["lock"]:
+                overlay["rows"].update(gs_rows)
+        return True, f"成功更新 {len(gs_rows)} 筆記錄"
     except Exception as e:
         return False, str(e)
 
@@ -138,6 +244,7 @@ def update_status_to_used(row_indices):
 # --- standby Parser ---
 # ============================================================
 
+@st.cache_data(ttl=600, max_entries=16, show_spinner=False)
 def parse_standby_table(df: pd.DataFrame):
     """
     解析 standby 表格
@@ -145,26 +252,26 @@ def parse_standby_table(df: pd.DataFrame):
     跳過 Status 為「已使用」的句子
     """
     groups = {}
-
-    for idx, row in df.iterrows():
-        school  = str(row.get("School", "")).strip()
-        level   = str(row.get("level", "")).strip()   # 小寫 level
-        word    = str(row.get("Word", "")).strip()
-        content = str(row.get("Content", "")).strip()
-        status  = str(row.get("Status", "")).strip()
-
-        if not (school and level and word and content):
-            continue
-        if status == "已使用":
-            continue
-
-        batch_key = f"{school}||{level}"
-        groups.setdefault(batch_key, {})
-        groups[batch_key].setdefault(word, {
-            "content": content,
-            "is_ready": True,
-            "row_index": idx
-        })
+    if df.empty:
+        return groups
+
+    # load_standby 已補齊欄位並去除空白
+    frame = df[["School", "level", "Word", "Content", "Status"]]   # 小寫 level
+
+    required_ok = (frame[["School", "level", "Word", "Content"]] != "").all(axis=1)
+    frame = frame[required_ok & (frame["Status"] != "已使用")]
+    # 同一批次同一詞語只取第一句（單次雜湊去重）
+    frame = frame[~frame.duplicated(subset=["School", "level", "Word"], keep="first")]
+
+    for (school, level), rows in frame.groupby(["School", "level"], sort=False):
+        groups[f"{school}||{level}"] = {
+            word: {
+                "content": content,
+                "is_ready": True,
+                "sheet_row": idx + 2   # pandas 0-based → Google Sheets 1-based (header = row 1)
+            }
+            for word, content, idx in zip(rows["Word"], rows["Content"], rows.index)
+        }
 
     return groups
 
@@ -187,17 +294,11 @@ def compute_batch_readiness(batch_key: str, word_dict: dict):
 def build_final_pool_for_batch(batch_key: str, word_dict: dict):
     """直接使用 standby 中所有可用句子"""
     school, level = batch_key.split("||")
-    questions = []
-    for word, data in word_dict.items():
-        content = data.get("content", "")
-        if content:
-            questions.append({
-                "Word": word,
-                "Content": content,
-                "School": school,
-                "Level": level,
-            })
-    return questions
+    return [
+        {"Word": word, "Content": data["content"], "School": school, "Level": level}
+        for word, data in word_dict.items()
+        if data.get("content")
+    ]
 
 # ============================================================
 # --- PDF Text Rendering Helpers ---
@@ -258,12 +359,53 @@ def draw_text_with_underline_wrapped(c, x, y, text, font_name, font_size, max_wi
 # --- Student Worksheet PDF Generator (WITH HEADER ON EVERY PAGE) ---
 # ============================================================
 
-def create_pdf(school_name, level, questions, student_name=None, original_questions=None):
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, TableStyle, Frame, PageTemplate
+@st.cache_resource
+def _pdf_styles(font_name):
+    """工作紙 PDF 樣式：每個字型只建立一次，所有學生共用"""
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.units import inch
-    from reportlab.lib import colors
     from reportlab.lib.enums import TA_CENTER
+    from reportlab.platypus import TableStyle
+    from reportlab.lib import colors
+
+    styles = getSampleStyleSheet()
+    return {
+        "title": ParagraphStyle('Title', parent=styles['Heading1'], fontName=font_name, fontSize=22, alignment=TA_CENTER, spaceAfter=12),
+        "normal": ParagraphStyle('Normal', parent=styles['Normal'], fontName=font_name, fontSize=18, leading=26),
+        "vocab_title": ParagraphStyle('VocabTitle', parent=styles['Heading2'], fontName=font_name, fontSize=20, alignment=TA_CENTER, spaceAfter=20),
+        # 表格樣式亦只建立一次，所有題目及詞語表共用
+        "question_table": TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('BOTTOMPADDING', (0,0), (-1,-1), 6)]),
+        "vocab_table": TableStyle([
+            ('FONTNAME', (0,0), (-1,-1), font_name), ('FONTSIZE', (0,0), (-1,-1), 22),
+            ('ALIGN', (0,0), (-1,-1), 'CENTER'), ('GRID', (0,0), (-1,-1), 1, colors.black),
+            ('TOPPADDING', (0,0), (-1,-1), 16), ('BOTTOMPADDING', (0,0), (-1,-1), 16)
+        ]),
+    }
+
+
+@st.cache_resource
+def _question_markup_cache():
+    """【】→ markup 的記憶化函式；放在 cache_resource 中，跨 rerun 及所有 session 共用（lru_cache 本身執行緒安全）"""
+    @functools.lru_cache(maxsize=4096)
+    def markup(content):
+        content = _RE_DOUBLE.sub(r'<u>\1</u>', content) # 專名號
+        content = _RE_SINGLE.sub(r'<u>________</u>', content) # 填充位
+        return content
+    return markup
+
+
+def _question_markup(content):
+    """將句子中的【】標記轉成 Paragraph markup（同一句子在整個程序中只轉換一次）"""
+    return _question_markup_cache()(content)
+
+
+def next_worksheet_date():
+    """工作紙日期（明天）"""
+    return datetime.date.today() + datetime.timedelta(days=1)
+
+
+def create_pdf(school_name, level, questions, student_name=None, original_questions=None, issue_date=None):
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, Frame, PageTemplate
+    from reportlab.lib.units import inch
     from reportlab.lib.pagesizes import letter
 
     bio = io.BytesIO()
@@ -282,30 +424,32 @@ def create_pdf(school_name, level, questions, student_name=None, original_questi
     doc.addPageTemplates(template)
 
     story = []
-    styles = getSampleStyleSheet()
     font_name = CHINESE_FONT if CHINESE_FONT else 'Helvetica'
 
-    # --- 樣式設定 ---
-    title_style = ParagraphStyle('Title', parent=styles['Heading1'], fontName=font_name, fontSize=22, alignment=TA_CENTER, spaceAfter=12)
-    normal_style = ParagraphStyle('Normal', parent=styles['Normal'], fontName=font_name, fontSize=18, leading=26)
-    vocab_title_style = ParagraphStyle('VocabTitle', parent=styles['Heading2'], fontName=font_name, fontSize=20, alignment=TA_CENTER, spaceAfter=20)
+    # --- 樣式設定（共用快取）---
+    pdf_styles = _pdf_styles(font_name)
+    title_style = pdf_styles["title"]
+    normal_style = pdf_styles["normal"]
+    vocab_title_style = pdf_styles["vocab_title"]
 
     # --- 第一頁：標題與題目 ---
     title_text = f"<b>{school_name} ({level}) - {student_name if student_name else ''} - 校本填充工作紙</b>"
     story.append(Paragraph(title_text, title_style))
     story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph(f"日期: {datetime.date.today() + datetime.timedelta(days=1)}", normal_style))
+    story.append(Paragraph(f"日期: {issue_date or next_worksheet_date()}", normal_style))
     story.append(Spacer(1, 0.3*inch))
 
-    for i, row in enumerate(questions):
-        content = row['Content']
-        content = re.sub(r'【】(.*?)【】', r'<u>\1</u>', content) # 專名號
-        content = re.sub(r'【(.+?)】', r'<u>________</u>', content) # 填充位
-        
-        t = Table([[Paragraph(f"<b>{i+1}.</b>", normal_style), Paragraph(content, normal_style)]], colWidths=[0.5*inch, 6.7*inch])
-        t.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('BOTTOMPADDING', (0,0), (-1,-1), 6)]))
-        story.append(t)
-        story.append(Spacer(1, 0.15*inch))
+    question_table_style = pdf_styles["question_table"]
+
+    def question_row(i, row):
+        t = Table([[Paragraph(f"<b>{i+1}.</b>", normal_style),
+                    Paragraph(_question_markup(row['Content']), normal_style)]],
+                  colWidths=[0.5*inch, 6.7*inch])
+        t.setStyle(question_table_style)
+        # Spacer 不可共用：reportlab 以物件 identity 偵測排版迴圈，共用實例會誤報 LayoutError
+        return t, Spacer(1, 0.15*inch)
+
+    story.extend(itertools.chain.from_iterable(question_row(i, row) for i, row in enumerate(questions)))
 
     # --- 第二頁：詞語表 (確保按輸入順序) ---
     # --- PAGE 2: Vocabulary Table ---
@@ -321,11 +465,8 @@ def create_pdf(school_name, level, questions, student_name=None, original_questi
         # Fallback if original is not provided
         words = [row.get('Word', '').strip() for row in questions]
     
-    # Remove duplicates while preserving the order established above
-    unique_words = []
-    for w in words:
-        if w and w not in unique_words:
-            unique_words.append(w)
+    # Remove duplicates while preserving the order established above (hashed lookup)
+    unique_words = [w for w in dict.fromkeys(words) if w]
 
     if unique_words:
         story.append(PageBreak())
@@ -339,17 +480,36 @@ def create_pdf(school_name, level, questions, student_name=None, original_questi
             table_data.append(row)
 
         vocab_table = Table(table_data, colWidths=[1.8*inch]*4)
-        vocab_table.setStyle(TableStyle([
-            ('FONTNAME', (0,0), (-1,-1), font_name), ('FONTSIZE', (0,0), (-1,-1), 22),
-            ('ALIGN', (0,0), (-1,-1), 'CENTER'), ('GRID', (0,0), (-1,-1), 1, colors.black),
-            ('TOPPADDING', (0,0), (-1,-1), 16), ('BOTTOMPADDING', (0,0), (-1,-1), 16)
-        ]))
+        vocab_table.setStyle(pdf_styles["vocab_table"])
         story.append(vocab_table)
 
     doc.build(story)
     bio.seek(0)
     return bio
 
+
+def _questions_key(questions):
+    """題目清單 → 可雜湊的 ((Word, Content), ...)"""
+    return tuple((q.get("Word", ""), q["Content"]) for q in questions)
+
+
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def _cached_pdf_bytes(school_name, level, student_name, questions_key, original_key, issue_date):
+    questions = [{"Word": w, "Content": c} for w, c in questions_key]
+    original = [{"Word": w, "Content": c} for w, c in original_key] if original_key is not None else None
+    return create_pdf(school_name, level, questions, student_name=student_name,
+                      original_questions=original, issue_date=issue_date).getvalue()
+
+
+def create_pdf_bytes(school_name, level, questions, student_name=None, original_questions=None, issue_date=None):
+    """create_pdf 的快取版本：相同學校、學生、題目及日期只生成一次，回傳 bytes"""
+    return _cached_pdf_bytes(
+        school_name, level, student_name,
+        _questions_key(questions),
+        _questions_key(original_questions) if original_questions is not None else None,
+        issue_date or next_worksheet_date(),
+    )
+
 # ============================================================
 # --- Teacher Answer PDF Generator ---
 # ============================================================
@@ -393,6 +553,16 @@ def create_answer_pdf(school_name, level, questions):
     bio.seek(0)
     return bio
 
+
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def _cached_answer_pdf_bytes(school_name, level, words):
+    return create_answer_pdf(school_name, level, [{"Word": w} for w in words]).getvalue()
+
+
+def create_answer_pdf_bytes(school_name, level, questions):
+    """create_answer_pdf 的快取版本：相同詞語順序只生成一次，回傳 bytes"""
+    return _cached_answer_pdf_bytes(school_name, level, tuple(q["Word"] for q in questions))
+
 # ============================================================
 # --- DOCX Worksheet Generator ---
 # ============================================================
@@ -410,7 +580,7 @@ def create_docx(school_name, level, questions, student_name=None):
     doc.add_paragraph("")
 
     for i, row in enumerate(questions):
-        content = re.sub(r'【|】', '', row["Content"])
+        content = _RE_BRACKETS.sub('', row["Content"])
         p = doc.add_paragraph(style="List Number")
         run = p.add_run(content)
         run.font.size = Pt(18)
@@ -424,20 +594,26 @@ def create_docx(school_name, level, questions, student_name=None):
 # --- SendGrid Email Sender ---
 # ============================================================
 
+@st.cache_resource(show_spinner=False)
+def _sendgrid():
+    """SendGrid client 及設定：每個程序只建立一次，所有寄送（含背景執行緒）共用"""
+    sg_config = dict(st.secrets["sendgrid"])
+    return SendGridAPIClient(sg_config["api_key"]), sg_config
+
+
 def send_email_with_pdf(to_email, student_name, school_name, grade, pdf_bytes, cc_email=None):
     try:
-        sg_config = st.secrets["sendgrid"]
+        sg, sg_config = _sendgrid()
         recipient = str(to_email).strip()
 
-        if not re.match(r'^[\w\.-]+@[\w\.-]+\.\w+$', recipient):
+        if not _RE_EMAIL.match(recipient):
             return False, f"無效的家長電郵格式: '{recipient}'"
 
         from_email_obj = Email(sg_config["from_email"], sg_config.get("from_name", ""))
-        safe_name = re.sub(r'[^\w\-]', '_', str(student_name).strip())
+        safe_name = _RE_SAFE_NAME.sub('_', str(student_name).strip())
 
         message = Mail(
             from_email=from_email_obj,
-            to_emails=recipient,
             subject=f"【工作紙】{school_name} ({grade}) - {student_name} 的校本填充練習",
             html_content=f"""
                 <p>親愛的家長您好：</p>
@@ -447,10 +623,16 @@ def send_email_with_pdf(to_email, student_name, school_name, grade, pdf_bytes, c
             """
         )
 
-        if cc_email:
-            cc_clean = str(cc_email).strip().lower()
-            if cc_clean not in ["n/a", "nan", "", "none"] and "@" in cc_clean and cc_clean != recipient.lower():
-                message.add_cc(cc_clean)
+        # 家長 + 所有副本收件人共用同一個 personalization，一次 API 請求寄出
+        personalization = Personalization()
+        personalization.add_to(To(recipient))
+        seen = {recipient.lower()}
+        for cc in _RE_EMAIL_SEP.split(str(cc_email or "")):
+            cc_clean = cc.strip().lower()
+            if cc_clean not in ["n/a", "nan", "", "none"] and "@" in cc_clean and cc_clean not in seen:
+                personalization.add_cc(Cc(cc_clean))
+                seen.add(cc_clean)
+        message.add_personalization(personalization)
 
         encoded_pdf = base64.b64encode(pdf_bytes).decode()
         attachment = Attachment(
@@ -461,7 +643,6 @@ def send_email_with_pdf(to_email, student_name, school_name, grade, pdf_bytes, c
         )
         message.add_attachment(attachment)
 
-        sg = SendGridAPIClient(sg_config["api_key"])
         response = sg.send(message)
 
         if 200 <= response.status_code < 300:
@@ -478,13 +659,104 @@ def send_email_with_pdf(to_email, student_name, school_name, grade, pdf_bytes, c
     except Exception as e:
         return False, str(e)
 
+def send_emails_in_parallel(jobs, max_workers=8):
+    """多執行緒同時寄送；jobs 為 send_email_with_pdf 的參數 dict，回傳 [(ok, msg), ...]"""
+    def _send(job):
+        return send_email_with_pdf(**job)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as ex:
+        return list(ex.map(_send, jobs))
+
+# ============================================================
+# --- Background Email Queue ---
+# ============================================================
+
+EMAIL_RESULT_TTL = datetime.timedelta(hours=1)  # 已完成的寄送結果保留時間
+EMAIL_STATE_LABELS = {"queued": "⏳ 已排隊", "sent": "✅ 發送成功", "unknown": "❔ 狀態不明（佇列已重設）"}  # failed 顯示錯誤訊息
+
+
+@st.cache_resource
+def _email_queue():
+    """背景寄送佇列：daemon 執行緒逐一寄送，結果寫入共用 dict（以 lock 保護）"""
+    jobs = queue.Queue()
+    results = {}
+    lock = threading.Lock()
+
+    def _drain():
+        while True:
+            job_id, job = jobs.get()
+            try:
+                ok, msg = send_email_with_pdf(**job)
+            except Exception as e:
+                ok, msg = False, str(e)
+            now = datetime.datetime.now()
+            with lock:
+                results[job_id] = (now, "sent" if ok else "failed", msg)
+                # 清除逾時的已完成結果；session 取得結果後已自行保存
+                expired = [k for k, (ts, state, _) in results.items()
+                           if state != "queued" and now - ts > EMAIL_RESULT_TTL]
+                for k in expired:
+                    del results[k]
+            jobs.task_done()
+
+    threading.Thread(target=_drain, daemon=True).start()
+    return jobs, results, lock
+
+
+def enqueue_email(job):
+    """將寄送工作加入背景佇列，立即回傳 job_id"""
+    jobs, results, lock = _email_queue()
+    job_id = uuid.uuid4().hex
+    with lock:
+        results[job_id] = (datetime.datetime.now(), "queued", "已排隊")
+    jobs.put((job_id, job))
+    return job_id
+
+
+def email_job_status(job_id):
+    """
+    回傳 (時間, 狀態, 訊息)；狀態為 queued / sent / failed
+    佇列被重設（例如清除快取）或結果已逾時清除時為 unknown
+    """
+    _, results, lock = _email_queue()
+    with lock:
+        return results.get(job_id, (None, "unknown", "未知工作"))
+
 # ============================================================
 # --- PDF Preview Helper ---
 # ============================================================
 
-def display_pdf_as_images(pdf_bytes):
+@st.cache_data(ttl=300, max_entries=64, show_spinner=False)
+def _rasterize_pdf(pdf_bytes: bytes, dpi: int = 110, first_page=None, last_page=None):
+    """PDF → JPEG bytes；以 PDF 內容為快取鍵，同一份 PDF 只轉換一次（快取壓縮後的 bytes，不存 PIL 圖片）"""
+    # pdftocairo 直接輸出 JPEG 檔並多執行緒轉換各頁；讀回檔案 bytes，不必經 PIL 解碼再編碼
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = convert_from_bytes(
+            pdf_bytes, dpi=dpi, first_page=first_page, last_page=last_page,
+            fmt="jpeg", jpegopt={"quality": 80, "optimize": True},
+            use_pdftocairo=True, thread_count=min(4, os.cpu_count() or 1),
+            output_folder=tmp, paths_only=True, timeout=30,
+        )
+        pages = []
+        for path in paths:
+            with open(path, "rb") as f:
+                pages.append(f.read())
+    return pages
+
+
+PREVIEW_PAGES = 2  # 預覽預設顯示的頁數
+
+
+def display_pdf_as_images(pdf_bytes, key="pdf_preview"):
+    """預設只顯示前兩頁；勾選「顯示全部頁面」才轉換其餘頁面"""
     try:
-        images = convert_from_bytes(pdf_bytes, dpi=150)
+        if hasattr(pdf_bytes, "getvalue"):
+            pdf_bytes = pdf_bytes.getvalue()
+        show_all = st.toggle("🔍 顯示全部頁面", key=f"{key}_all_pages")
+        if show_all:
+            images = _rasterize_pdf(pdf_bytes)
+        else:
+            images = _rasterize_pdf(pdf_bytes, first_page=1, last_page=PREVIEW_PAGES)
         for i, image in enumerate(images):
             st.image(image, caption=f"Page {i+1}", use_container_width=True)
     except Exception as e:
@@ -500,6 +772,22 @@ with st.spinner("正在載入資料，請稍候..."):
     standby_df = load_standby()
     standby_groups = parse_standby_table(standby_df)
 
+# 本 session 已鎖定的批次：句子已標記「已使用」而不再出現在 standby，仍須保留可選，方便預覽及寄送
+locked_groups = {
+    k: {q["Word"]: {"content": q["Content"], "is_ready": True} for q in qs}
+    for k, qs in st.session_state.final_pool.items()
+    if k in st.session_state.confirmed_batches and k not in standby_groups
+}
+batch_groups = {**standby_groups, **locked_groups}
+
+# 依年級分組一次，側邊欄及各標籤頁直接取用；儀表板只計 standby 中仍可用的批次
+groups_by_level, standby_by_level = {}, {}
+for _batch_key, _word_dict in batch_groups.items():
+    _level = _batch_key.split("||")[1]
+    groups_by_level.setdefault(_level, {})[_batch_key] = _word_dict
+    if _batch_key in standby_groups:
+        standby_by_level.setdefault(_level, {})[_batch_key] = _word_dict
+
 # ============================================================
 # --- Sidebar Controls ---
 # ============================================================
@@ -512,10 +800,9 @@ with st.sidebar:
         col_r, col_s = st.columns(2)
 
         with col_r:
-            if st.button("🔄 更新資料", use_container_width=True, help="點擊重新載入 Google Sheets 資料"):
+            if st.button("🔄 更新資料", use_container_width=True, help="資料每 10 分鐘自動更新；點擊可立即重新載入 Google Sheets 資料"):
                 with st.spinner("正在同步最新資料..."):
-                    load_students.clear()
-                    load_standby.clear()
+                    load_all_sheets.clear()
                     st.session_state.final_pool = {}
                     st.session_state.confirmed_batches = set()
                     st.session_state.shuffled_cache = {}
@@ -534,12 +821,12 @@ with st.sidebar:
         st.subheader("🔍 篩選條件")
         
         # 1. 先選學校
-        all_schools = sorted({k.split("||")[0] for k in standby_groups}) if standby_groups else ["無資料"]
+        all_schools = sorted({k.split("||")[0] for k in batch_groups}) if batch_groups else ["無資料"]
         selected_school = st.selectbox("🏫 選擇學校", all_schools)
         
         # 2. 根據學校過濾年級
         available_levels = sorted({
-            k.split("||")[1] for k in standby_groups 
+            k.split("||")[1] for k in batch_groups
             if k.startswith(f"{selected_school}||")
         })
         selected_level = st.selectbox(
@@ -564,12 +851,12 @@ with st.sidebar:
     with st.container(border=True):
         st.subheader("📊 資料概覽")
 
-        level_batches = [k for k in standby_groups if k.endswith(f"||{selected_level}")]
-        total_words = sum(len(v) for k, v in standby_groups.items() if k.endswith(f"||{selected_level}"))
+        level_groups = standby_by_level.get(selected_level, {})
+        total_words = sum(len(v) for v in level_groups.values())
 
         # 計算已使用
         if standby_df is not None and not standby_df.empty:
-            used_count = standby_df[standby_df["Status"].str.strip() == "已使用"].shape[0]
+            used_count = int((standby_df["Status"] == "已使用").sum())
         else:
             used_count = 0
 
@@ -583,7 +870,7 @@ with st.sidebar:
 
         col_stat1, col_stat2 = st.columns(2)
         with col_stat1:
-            st.metric("批次數", len(level_batches))
+            st.metric("批次數", len(level_groups))
             st.metric("可用詞語", available_count, delta="📝 可用" if available_count > 0 else None)
         with col_stat2:
             st.metric("總詞語", total_words)
@@ -623,12 +910,18 @@ with st.sidebar:
 # --- Shuffle Helper ---
 # ============================================================
 
+@st.cache_resource
+def _rng():
+    """整個程序共用一個產生器（app.py 每次 rerun 都會重新執行，模組層級的物件留不住）"""
+    return np.random.default_rng()
+
+
 def get_shuffled_questions(questions, cache_key):
     if cache_key in st.session_state.shuffled_cache:
         return st.session_state.shuffled_cache[cache_key]
-    questions_list = list(questions)
-    random.seed(int(time.time() * 1000))
-    random.shuffle(questions_list)
+    # 在 C 層產生排列再一次取用，取代 Python 逐項交換的 random.shuffle
+    perm = _rng().permutation(len(questions))
+    questions_list = [questions[i] for i in perm]
     st.session_state.shuffled_cache[cache_key] = questions_list
     return questions_list
 
@@ -661,7 +954,7 @@ tab_lock, tab_preview, tab_email = st.tabs([
 with tab_lock:
     st.subheader("📥 題庫鎖定（Standby）")
 
-    level_groups = {k: v for k, v in standby_groups.items() if k.endswith(f"||{selected_level}")}
+    level_groups = groups_by_level.get(selected_level, {})
 
     if not level_groups:
         with st.container(border=True):
@@ -684,13 +977,13 @@ with tab_lock:
                 with st.container(border=True):
                     st.markdown("### 🔒 確認並鎖定題庫")
 
-                    row_indices = [
-                        data["row_index"]
+                    sheet_rows = [
+                        data["sheet_row"]
                         for data in word_dict.values()
-                        if "row_index" in data
+                        if "sheet_row" in data
                     ]
 
-                    st.info(f"即將鎖定並標記 {len(row_indices)} 個句子為「已使用」。")
+                    st.info(f"即將鎖定並標記 {len(sheet_rows)} 個句子為「已使用」。")
 
                     confirm_checkbox = st.checkbox(
                         "我確認要鎖定題庫並將這些句子標記為已使用",
@@ -704,10 +997,10 @@ with tab_lock:
                                 st.session_state.final_pool[batch_key] = final_qs
                                 st.session_state.confirmed_batches.add(batch_key)
 
-                                if row_indices:
-                                    update_ok, update_msg = update_status_to_used(row_indices)
+                                if sheet_rows:
+                                    update_ok, update_msg = update_status_to_used(sheet_rows)
                                     if update_ok:
-                                        st.success(f"✅ 已成功鎖定題庫並更新 {len(row_indices)} 個句子的 Status")
+                                        st.success(f"✅ 已成功鎖定題庫並更新 {len(sheet_rows)} 個句子的 Status")
                                     else:
                                         st.error(f"❌ 更新失敗：{update_msg}")
                                         st.info("💡 請確保 Google Service Account 有試算表的編輯權限")
@@ -734,6 +1027,8 @@ with tab_preview:
             st.info("請先到「題庫鎖定」標籤頁完成鎖定後，再回到此處下載工作紙。")
         st.stop()
 
+    preview_issue_date = next_worksheet_date()  # 所有學校共用同一日期
+
     for batch_key, questions in level_batches.items():
         with st.container(border=True):
             school, level = batch_key.split("||")
@@ -746,8 +1041,9 @@ with tab_preview:
 
             with st.spinner("正在生成 PDF..."):
                 # 使用隨機排序後的 shuffled_qs 生成 PDF
-                pdf_bytes = create_pdf(school, level, shuffled_qs, original_questions=questions)
-                answer_pdf_bytes = create_answer_pdf(school, level, shuffled_qs)
+                pdf_bytes = create_pdf_bytes(school, level, shuffled_qs, original_questions=questions,
+                                             issue_date=preview_issue_date)
+                answer_pdf_bytes = create_answer_pdf_bytes(school, level, shuffled_qs)
 
             col1, col2 = st.columns(2)
 
@@ -771,8 +1067,10 @@ with tab_preview:
                     help="下載包含答案的教師版 PDF"
                 )
 
+            # expander 收起時內容仍會執行，須勾選才轉換圖片，免得每次 rerun 為每個批次都呼叫 poppler
             with st.expander("📘 預覽學生版 PDF", expanded=False):
-                display_pdf_as_images(pdf_bytes)
+                if st.checkbox("載入預覽", key=f"load_preview_{batch_key}"):
+                    display_pdf_as_images(pdf_bytes, key=f"preview_{batch_key}")
 
 # ============================================================
 # --- 標籤頁 3: 寄送郵件 ---
@@ -781,6 +1079,42 @@ with tab_preview:
 with tab_email:
     st.subheader("✉️ 寄送郵件")
 
+    # --- 背景寄送狀態（排隊中時每 2 秒自動更新）---
+    st.session_state.setdefault("email_jobs", [])
+
+    def _job_status(j):
+        """已結束的結果存入 session，背景結果被清除後仍可顯示"""
+        if "final" not in j:
+            status = email_job_status(j["job_id"])
+            if status[1] == "queued":
+                return status
+            j["final"] = status
+        return j["final"]
+
+    if st.session_state.email_jobs:
+        has_pending = any(_job_status(j)[1] == "queued" for j in st.session_state.email_jobs)
+
+        @st.fragment(run_every="2s" if has_pending else None)
+        def _email_status_table():
+            status_rows = []
+            still_pending = False
+            for j in reversed(st.session_state.email_jobs):
+                ts, state, msg = _job_status(j)
+                still_pending |= state == "queued"
+                status_rows.append({
+                    "時間": ts.strftime("%H:%M:%S") if ts else "",
+                    "學生姓名": j["student_name"],
+                    "家長電郵": j["to_email"],
+                    "狀態": EMAIL_STATE_LABELS.get(state, f"❌ {msg}"),
+                })
+            st.dataframe(pd.DataFrame(status_rows), hide_index=True, use_container_width=True)
+            # run_every 於整頁執行時決定；全部完成後整頁重跑一次以停止輪詢
+            if has_pending and not still_pending:
+                st.rerun()
+
+        with st.expander("📬 寄送狀態", expanded=has_pending):
+            _email_status_table()
+
     if student_df.empty:
         st.error("❌ 學生資料表為空，無法寄送。")
         st.stop()
@@ -798,6 +1132,59 @@ with tab_email:
             st.info("請確認「學生資料」工作表中的學校名稱與年級是否完全匹配。")
         st.stop()
 
+    # --- 全部寄送：同一學校及年級的所有學生 ---
+    bulk_batch_key = f"{selected_school}||{selected_level}"
+    if bulk_batch_key in st.session_state.final_pool:
+        with st.container(border=True):
+            st.markdown(f"### 📧 全部寄送 ({selected_school} - {selected_level})")
+
+            bulk_targets = df_filtered[
+                ~df_filtered.get("家長 Email", pd.Series("", index=df_filtered.index))
+                .astype(str).str.strip().str.lower().isin(["n/a", "nan", "", "none"])
+            ]
+            st.caption(f"共 {len(bulk_targets)} / {len(df_filtered)} 位學生有家長電郵")
+
+            confirm_bulk = st.checkbox(
+                f"我確認要將工作紙寄送給以上 {len(bulk_targets)} 位學生的家長",
+                key=f"bulk_confirm_{bulk_batch_key}"
+            )
+
+            if confirm_bulk and not bulk_targets.empty:
+                if st.button("📧 全部寄送", type="primary", use_container_width=True, key=f"bulk_send_{bulk_batch_key}"):
+                    bulk_questions = st.session_state.final_pool[bulk_batch_key]
+                    bulk_issue_date = next_worksheet_date()  # 所有學生共用同一日期
+                    with st.spinner("正在生成 PDF 並寄送郵件，請稍候..."):
+                        jobs = []
+                        for _, student_row in bulk_targets.iterrows():
+                            name = student_row["學生姓名"]
+                            student_qs = get_shuffled_questions(bulk_questions, f"email_{bulk_batch_key}_{name}")
+                            pdf_bytes = create_pdf_bytes(selected_school, selected_level, student_qs,
+                                                         student_name=name, original_questions=bulk_questions,
+                                                         issue_date=bulk_issue_date)
+                            jobs.append({
+                                "to_email": student_row.get("家長 Email", ""),
+                                "student_name": name,
+                                "school_name": selected_school,
+                                "grade": selected_level,
+                                "pdf_bytes": pdf_bytes,
+                                "cc_email": student_row.get("老師 Email", ""),
+                            })
+                        results = send_emails_in_parallel(jobs)
+
+                    sent_ok = sum(1 for ok, _ in results if ok)
+                    if sent_ok == len(results):
+                        st.success(f"🎉 已成功寄出 {sent_ok} 份工作紙！")
+                    else:
+                        st.warning(f"⚠️ 已寄出 {sent_ok} / {len(results)} 份，部分寄送失敗。")
+                    st.dataframe(
+                        pd.DataFrame([
+                            {"學生姓名": job["student_name"], "結果": "✅ 發送成功" if ok else f"❌ {msg}"}
+                            for job, (ok, msg) in zip(jobs, results)
+                        ]),
+                        hide_index=True,
+                        use_container_width=True
+                    )
+
     # --- 優化點 2：顯示過濾後的名單 ---
     with st.container(border=True):
         st.markdown(f"### 👤 選擇學生 ({selected_school} - {selected_level})")
@@ -838,10 +1225,8 @@ with tab_email:
         st.markdown("### 📄 工作紙預覽")
 
         with st.spinner("正在生成 PDF..."):
-            # 這裡加上 .getvalue() 把文件對象轉成純數據
-            shuffled_email_qs = get_shuffled_questions(questions, f"email_{selected_student}")
-            pdf_obj = create_pdf(school, grade, shuffled_email_qs, student_name=selected_student, original_questions=questions)
-            pdf_bytes = pdf_obj.getvalue()
+            shuffled_email_qs = get_shuffled_questions(questions, f"email_{batch_key}_{selected_student}")
+            pdf_bytes = create_pdf_bytes(school, grade, shuffled_email_qs, student_name=selected_student, original_questions=questions)
 
         st.download_button(
             label="⬇️ 下載學生版 PDF",
@@ -881,23 +1266,22 @@ with tab_email:
             st.stop()
 
         if st.button("📨 寄出工作紙", type="primary", use_container_width=True):
-            with st.spinner("正在發送郵件，請稍候..."):
-                ok, msg = send_email_with_pdf(
-                    parent_email,
-                    selected_student,
-                    school,
-                    grade,
-                    pdf_bytes,
-                    cc_email=cc_email
-                )
-
-            if ok:
-                st.success("🎉 已成功寄出工作紙！")
-                st.balloons()
-                st.toast(f"工作紙已成功寄送給 {selected_student} 的家長！", icon="✅")
-            else:
-                st.error(f"❌ 寄送失敗：{msg}")
-                st.info("請檢查網路連線或稍後再試。")
+            # 交由背景執行緒寄送，頁面不必等待 SendGrid 回應
+            job_id = enqueue_email({
+                "to_email": parent_email,
+                "student_name": selected_student,
+                "school_name": school,
+                "grade": grade,
+                "pdf_bytes": pdf_bytes,
+                "cc_email": cc_email,
+            })
+            st.session_state.email_jobs.append({
+                "job_id": job_id,
+                "student_name": selected_student,
+                "to_email": parent_email,
+            })
+            st.toast(f"已將 {selected_student} 的工作紙加入寄送佇列", icon="📨")
+            st.rerun()
 
 # ============================================================
 # --- End of App ---